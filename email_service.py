@@ -1,5 +1,4 @@
 import os
-import sqlite3
 
 from dotenv import load_dotenv
 
@@ -8,14 +7,27 @@ from internal.database import Database
 from internal.analyse_emails import analyse_emails
 
 def fetch_all_emails(db: Database, hosts: list[str], users: list[str], passwords: list[str]):
-    for idx, host in enumerate(hosts):
-        user = users[idx]
-        password = passwords[idx]
+    # One account failing shouldn't stop the others from syncing, so report the failures once they have all had a go
+    failed_users: list[str] = []
 
-        print(f"Fetching emails from {user}")
-    
-        client = Client(db=db, host=host, username=user, password=password)
-        client.fetch_emails("ALL")
+    try:
+        for idx, host in enumerate(hosts):
+            user = users[idx]
+            password = passwords[idx]
+
+            print(f"Fetching emails from {user}")
+        
+            client = Client(db=db, host=host, username=user, password=password)
+            try:
+                client.fetch_emails("ALL")
+            except Exception as e:
+                print(f"Failed to fetch emails from {user}: {e}")
+                failed_users.append(user)
+    finally:
+        Client.close_mailboxes()
+
+    if len(failed_users) > 0:
+        raise RuntimeError(f"Failed to fetch emails from {len(failed_users)} account(s): {', '.join(failed_users)}")
 
 if __name__ == "__main__":
     load_dotenv()
@@ -38,8 +50,7 @@ if __name__ == "__main__":
     passwords = env_passwords.split(",")
     
     os.makedirs("data/database", exist_ok=True)
-    conn = sqlite3.connect("data/database/messages.db", isolation_level=None, check_same_thread=False)
-    db = Database(db=conn)
+    db = Database(path="data/database/messages.db")
 
     # Provide a menu of options for actions
     print("What would you like to do?")
@@ -5,7 +5,5 @@ def analyse_emails(db: Database):
     accounts: list[Account] = db.get_list_of_accounts()
 
     for account in accounts:
-        emails: list[Email] = db.get_emails(account=account)
-
-        for email in emails:
-            print(f"{account.username} - {email.datetime} - {email.mailbox} - {email.subject}")
\ No newline at end of file
+        for datetime, mailbox, subject in db.iter_emails_summary(account=account):
+            print(f"{account.username} - {datetime} - {mailbox} - {subject}")
\ No newline at end of file
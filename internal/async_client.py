@@ -0,0 +1,164 @@
+import asyncio
+import multiprocessing
+import os
+import re
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import aioimaplib
+from imap_tools import MailMessage
+from imap_tools.errors import MailboxFetchError, MailboxFolderSelectError, MailboxLoginError
+from imap_tools.utils import encode_folder
+
+from .client import FULL_MESSAGE_PARTS, ID_HEADER_PARTS, Client
+from .parser import parse_messages
+
+FETCH_RESPONSE_RE = re.compile(rb'^\d+ FETCH \(')
+
+# Folders fetched at once, each one holds its own IMAP session
+MAX_CONCURRENT_FOLDERS = 8
+
+# Batches of a folder that can be waiting to be parsed and written while the next one downloads
+MAX_PENDING_BATCHES = 2
+
+class AsyncClient(Client):
+    # Fetches with aioimaplib so that downloading the next batch overlaps parsing and writing the previous one
+    # aioimaplib only lets one FETCH be outstanding per connection, so concurrency between folders comes from separate sessions
+    async def _connect(self, folder: str) -> aioimaplib.IMAP4_SSL:
+        imap = aioimaplib.IMAP4_SSL(host=self.host)
+
+        try:
+            await imap.wait_hello_from_server()
+
+            response = await imap.login(self.username, self.password)
+            if response.result != "OK":
+                raise MailboxLoginError(response, "OK")
+
+            response = await imap.select(encode_folder(folder).decode())
+            if response.result != "OK":
+                raise MailboxFolderSelectError(response, "OK")
+        except BaseException:
+            # The caller only logs out once it has the session, so don't leave a half open one counting against the provider's limit
+            try:
+                await imap.logout()
+            except Exception:
+                pass
+            raise
+
+        return imap
+
+    async def _get_uids(self, imap: aioimaplib.IMAP4_SSL) -> list[str]:
+        response = await imap.uid_search("ALL", charset=None)
+        if response.result != "OK":
+            raise MailboxFetchError(response, "OK")
+
+        # The first line holds the matching UIDs, the last is the tagged completion
+        return response.lines[0].decode().split() if len(response.lines) > 1 else []
+
+    async def _fetch_batch(self, imap: aioimaplib.IMAP4_SSL, uids: list[str], message_parts: str) -> list[list]:
+        response = await imap.uid("FETCH", ",".join(uids), message_parts)
+        if response.result != "OK":
+            raise MailboxFetchError(response, "OK")
+
+        # Convert to the (envelope, body) tuple followed by the closing line that MailMessage expects
+        batch: list[list] = []
+        lines = response.lines
+        for i in range(len(lines) - 1):
+            if isinstance(lines[i], bytes) and isinstance(lines[i + 1], bytearray):
+                fetch_data: list = [(lines[i], bytes(lines[i + 1]))]
+
+                # Servers may send the remaining attributes after the body, unless the next message starts straight away
+                if i + 2 < len(lines) and isinstance(lines[i + 2], bytes) and not FETCH_RESPONSE_RE.match(lines[i + 2]):
+                    fetch_data.append(lines[i + 2])
+
+                batch.append(fetch_data)
+
+        return batch
+
+    async def _parse_and_store(self, parse_executor: Executor, store_executor: Executor, folder: str, batch: list[list]) -> None:
+        loop = asyncio.get_running_loop()
+        parsed_messages = await loop.run_in_executor(parse_executor, parse_messages, self.account, folder, batch)
+
+        await loop.run_in_executor(store_executor, self._store_parsed_messages, parsed_messages)
+
+    async def _fetch_emails_from_folder_async(self, folder: str, parse_executor: Executor, store_executor: Executor, sessions: asyncio.Semaphore) -> None:
+        async with sessions:
+            print(f"{self.account.username}: Querying folder: {folder}")
+            imap = await self._connect(folder=folder)
+
+            try:
+                uids = await self._get_uids(imap)
+                print(f"{self.account.username}: Found {len(uids)} messages in folder: {folder}")
+
+                uid_hashes: list[tuple[str, int]] = []
+
+                for i in range(0, len(uids), self.fetch_batch_size):
+                    for fetch_data in await self._fetch_batch(imap, uids[i:i + self.fetch_batch_size], ID_HEADER_PARTS):
+                        try:
+                            message = MailMessage(fetch_data)
+                            hash = self.parser.generate_email_id_from_headers(date_str=message.date_str, from_=message.from_, subject=message.subject)
+                        except Exception as e:
+                            print(e)
+                            continue
+
+                        uid_hashes.append((message.uid or "", hash))
+
+                existing_hashes = await asyncio.to_thread(self.db.existing_email_hashes, [hash for _, hash in uid_hashes])
+                missing_emails: list[str] = [uid for uid, hash in uid_hashes if hash not in existing_hashes]
+
+                if len(missing_emails) == 0:
+                    return
+
+                print(f"{self.account.username}: Fetching {len(missing_emails)} missing emails from folder: {folder}")
+
+                pending: list[asyncio.Task] = []
+
+                try:
+                    for i in range(0, len(missing_emails), self.fetch_batch_size):
+                        batch = await self._fetch_batch(imap, missing_emails[i:i + self.fetch_batch_size], FULL_MESSAGE_PARTS)
+                        pending.append(asyncio.create_task(self._parse_and_store(parse_executor, store_executor, folder, batch)))
+
+                        # Don't let downloads run too far ahead of parsing and writing
+                        if len(pending) > MAX_PENDING_BATCHES:
+                            await pending.pop(0)
+
+                    await asyncio.gather(*pending)
+                except BaseException:
+                    for task in pending:
+                        task.cancel()
+                    raise
+            finally:
+                await imap.logout()
+
+            print(f"{self.account.username}: Finished Fetching Emails from folder: {folder}")
+
+    async def fetch_emails_async(self, folder: str = "ALL") -> None:
+        if folder == "ALL":
+            folders = await asyncio.to_thread(self._get_folders)
+        else:
+            folders = [folder]
+
+        sessions = asyncio.Semaphore(MAX_CONCURRENT_FOLDERS)
+
+        # Worker processes are spawned rather than forked, as forking while other threads hold locks isn't safe
+        # Writes all go through one thread, so batches from different folders don't fight over SQLite's write lock
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn")) as parse_executor, \
+                ThreadPoolExecutor(max_workers=1) as store_executor:
+            results = await asyncio.gather(
+                *[self._fetch_emails_from_folder_async(folder, parse_executor, store_executor, sessions) for folder in folders],
+                return_exceptions=True
+            )
+
+        errors: list[BaseException] = []
+        for folder, result in zip(folders, results):
+            if isinstance(result, BaseException):
+                print(f"{self.account.username}: Failed to fetch emails from folder: {folder}: {result}")
+                errors.append(result)
+
+        if len(errors) > 0:
+            raise RuntimeError(f"{self.account.username}: Failed to fetch emails, {len(errors)} error(s)") from errors[0]
+
+        print(f"{self.account.username}: Finished Fetching Emails")
+
+    def fetch_emails(self, folder: str = "ALL") -> None:
+        asyncio.run(self.fetch_emails_async(folder=folder))
@@ -1,181 +1,230 @@
-import hashlib
-import re
+import imaplib
+import math
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Iterator
+
+from imap_tools import MailBox, MailMessage
+from imap_tools.errors import MailboxFetchError, MailboxLoginError, UnexpectedCommandStatusError
+from imap_tools.utils import check_command_status
+
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+from .models import Account, Email, EmailAttachment
+from .database import Database
+from .parser import MessageParser, parse_messages
 
-from imap_tools import OR, MailBox, MailMessage
-from inscriptis import get_text
+FOLDER_WORKERS = 14
 
-from concurrent.futures import ThreadPoolExecutor
-from .models import Account, Attachment, Email, EmailAttachment
-from .database import Database
+# Folders with at least this many messages are split into UID ranges, so one large folder can use several threads
+MIN_UIDS_TO_SPLIT = 1000
+UID_RANGE_PARTS = 4
+
+FULL_MESSAGE_PARTS = "(BODY.PEEK[] UID FLAGS RFC822.SIZE)"
+# Only the headers that make up the email id, which is all the existence check needs
+ID_HEADER_PARTS = "(UID BODY.PEEK[HEADER.FIELDS (DATE FROM SUBJECT)])"
+
+# Servers drop idle connections after ~30 minutes, so send a NOOP before reusing one that has been idle this long
+MAILBOX_NOOP_AFTER_SECONDS = 25 * 60
 
 class Client:
-    def __init__(self, db: Database, host: str, username: str, password: str) -> None:
+    # Authenticated mailboxes that are not currently in use, keyed by (host, username)
+    # Each worker checks a mailbox out of the pool, so a connection is never shared between threads
+    _mailbox_pool: dict[tuple[str, str], list[tuple[MailBox, float]]] = {}
+    _mailbox_pool_lock = threading.Lock()
+
+    def __init__(self, db: Database, host: str, username: str, password: str, fetch_batch_size: int = 100) -> None:
         self.host: str = host
         self.username: str = username
         self.password: str = password
         self.db: Database = db
 
+        # Number of UIDs per IMAP FETCH command, some servers (e.g. iCloud, Gmail) cap the size of a single command
+        self.fetch_batch_size: int = fetch_batch_size
+
         self.account: Account = self.db.get_account(username=username)
+        self.parser: MessageParser = MessageParser(account=self.account)
     
-    def _convert_MailMessage_to_Email_and_EmailAttachments(self, folder: str, message: MailMessage) -> tuple[Email, list[EmailAttachment]]:
-        to_addresses = ",".join([email.email.lower() for email in message.to_values])
-
-        subject = message.subject.replace("\n", " ").strip()
-
-        email = Email(
-            hash = self._generate_email_id(message=message),
-            account_id = self.account.id,
-            datetime = message.date,
-            mailbox = folder,
-            mailbox_id = (message.uid or ""),
-            from_address = message.from_.lower(),
-            to_addresses = to_addresses,
-            subject = subject,
-            thread = self._convert_subject_to_thread(subject=subject),
-            text = self._get_text(message=message),
-            analytics_version = 0,
-            analytics_data = {}
-        )
-
-        emailAttachments: list[EmailAttachment] = []
-
-        for message_attachment in message.attachments:
-             # Exclude certain file types
-            if message_attachment.content_type in ["application/ics", "text/calendar", "text/calender"]:
-                continue
+    def _acquire_mailbox(self, folder: str) -> MailBox:
+        key = (self.host, self.username)
 
-            if message_attachment.content_type in ["message/rfc822", "message/delivery-status", "text/html", "text/plain"]:
-                continue
+        with Client._mailbox_pool_lock:
+            idle_mailboxes = Client._mailbox_pool.get(key, [])
+            pooled = idle_mailboxes.pop() if idle_mailboxes else None
 
-            if "image/" in message_attachment.content_type:
-                continue
+        if pooled is not None:
+            mailbox, last_used = pooled
+            try:
+                if time.monotonic() - last_used > MAILBOX_NOOP_AFTER_SECONDS:
+                    mailbox.client.noop()
+
+                mailbox.folder.set(folder)
+                return mailbox
+            except (imaplib.IMAP4.error, OSError, UnexpectedCommandStatusError):
+                # The connection has gone stale, fall through and log in again
+                self._logout_quietly(mailbox)
+
+        try:
+            return MailBox(self.host).login(self.username, self.password, initial_folder=folder)
+        except MailboxLoginError:
+            # The credentials are no longer valid, so none of the pooled mailboxes for this account can be trusted
+            self._invalidate_mailboxes()
+            raise
+
+    def _release_mailbox(self, mailbox: MailBox) -> None:
+        with Client._mailbox_pool_lock:
+            Client._mailbox_pool.setdefault((self.host, self.username), []).append((mailbox, time.monotonic()))
+
+    def _invalidate_mailboxes(self) -> None:
+        with Client._mailbox_pool_lock:
+            pooled = Client._mailbox_pool.pop((self.host, self.username), [])
+
+        for mailbox, _ in pooled:
+            self._logout_quietly(mailbox)
+
+    @staticmethod
+    def _logout_quietly(mailbox: MailBox) -> None:
+        try:
+            mailbox.logout()
+        except (imaplib.IMAP4.error, OSError, UnexpectedCommandStatusError):
+            # MailBox.logout raises MailboxLogoutError if the server doesn't answer with BYE
+            pass
+
+    @classmethod
+    def close_mailboxes(cls) -> None:
+        with cls._mailbox_pool_lock:
+            pooled = [mailbox for mailboxes in cls._mailbox_pool.values() for mailbox, _ in mailboxes]
+            cls._mailbox_pool.clear()
+
+        for mailbox in pooled:
+            cls._logout_quietly(mailbox)
+
+    @contextmanager
+    def _mailbox(self, folder: str = "INBOX") -> Iterator[MailBox]:
+        mailbox = self._acquire_mailbox(folder=folder)
+
+        try:
+            yield mailbox
+        except BaseException:
+            # We don't know what state the connection was left in, so don't return it to the pool
+            self._logout_quietly(mailbox)
+            raise
+        else:
+            self._release_mailbox(mailbox)
 
-            attachment = Attachment(
-                hash = hashlib.sha256(message_attachment.payload).hexdigest(),
-                content = message_attachment.payload
-            )
-
-            emailAttachment = EmailAttachment(
-                account_id = self.account.id,
-                email_hash = email.hash,
-                attachment_hash = attachment.hash,
-                filename = message_attachment.filename,
-                content_type = message_attachment.content_type,
-                attachment = attachment
-            )
-
-            emailAttachments.append(emailAttachment)
-        
-        return email, emailAttachments
+    def _get_folders(self) -> list[str]:
+        with self._mailbox() as mailbox:
+            folders : list[str] = []
+            for folder in mailbox.folder.list():
+                if folder.name in ["Outbox", "Notes", "Junk", "Drafts", "Trash"]:
+                    continue
 
-    def _generate_email_id(self, message: MailMessage) -> str:
-        return hashlib.sha256(f"{self.account.username}_{message.date_str}{message.from_}{message.subject}".encode()).hexdigest()
+                if folder.name.startswith("Sync Issues") or folder.name.startswith("Deleted"):  
+                    continue
 
-    def _convert_subject_to_thread(self, subject: str) -> str:
-        thread = subject.lower()
+                folders.append(folder.name)
 
-        # Strip out all Re: and Fwd: from the subject
-        thread = thread.replace("re: ", "")
-        thread = thread.replace("fwd: ", "")
+            return folders
+    
+    def _get_uid_ranges(self, folder: str, parts: int = UID_RANGE_PARTS) -> list[list[str]]:
+        with self._mailbox(folder=folder) as mailbox:
+            uids = mailbox.uids()
 
-        thread = re.sub(r':\s+\w+\s+\d{1,2},\s+\d{4}', '', thread)
+        # Searches run on several threads at once, tqdm.write serialises their output
+        tqdm.write(f"{self.account.username}: Found {len(uids)} messages in folder: {folder}")
 
-        # Now strip all Emoji Characters, leaving only ASCII
-        thread = thread.encode("ascii", "ignore").decode()
+        if len(uids) == 0:
+            return []
 
-        # Now join multiple lines into one
-        thread = " ".join(thread.splitlines())
+        if len(uids) < MIN_UIDS_TO_SPLIT:
+            return [uids]
 
-        # Now replace multiple spaces with a single space
-        thread = re.sub(r'\s+', ' ', thread)
-    
-        return thread
-    
-    def _get_text(self, message: MailMessage) -> str:
-        text: str = ""
-        if message.html != "":
-            text = get_text(html_content=message.html)
-        elif message.text != "":
-            text = message.text
-        
-        # Trim whitespace from the beginning and end of each line
-        text = "\n".join([line.strip() for line in text.split("\n")])   
+        # Contiguous chunks, so each range is fetched in UID order
+        size = math.ceil(len(uids) / parts)
+        return [uids[i:i + size] for i in range(0, len(uids), size)]
 
-        # Now strip out all the empty lines
-        text = "\n".join([line for line in text.split("\n") if line != ""])
+    def _get_message_id_headers_from_folder(self, folder: str, uids: list[str], mailbox: MailBox | None = None) -> list[MailMessage]:
+        # Messages with just the Date, From and Subject headers, parsed the same way as full messages so the ids match
+        if mailbox is None:
+            with self._mailbox(folder=folder) as mailbox:
+                return self._get_message_id_headers_from_folder(folder=folder, uids=uids, mailbox=mailbox)
 
-        # Strip out any lines that start with RFC 5322 Message Headers, e.g. "From: ", "To: ", "Subject: ", etc. or a quoted reply
-        text = "\n".join([line for line in text.split("\n") if not line.upper().startswith(("FROM: ", "TO: ", "SUBJECT: ", "DATE: ", "CC: ", "BCC: ", "> ", ">> "))]) 
+        return [MailMessage(fetch_data) for batch in self._get_raw_messages_from_folder(folder=folder, uids=uids, mailbox=mailbox, message_parts=ID_HEADER_PARTS) for fetch_data in batch]
 
-        # Now remove content that does not provide any value
-        text = text.replace("________________________________", "")
-        text = text.replace("This message was sent from a notification-only email address that does not accept incoming email. Please do not reply to this message.", "")   
-        text = text.replace("This is an automated message. Please do not reply to this email.", "")   
+    def _get_raw_messages_from_folder(self, folder: str, uids: list[str], mailbox: MailBox | None = None, message_parts: str = FULL_MESSAGE_PARTS) -> Iterator[list[list]]:
+        # Yields the unparsed fetch data for the messages in batches, so parsing can happen in another process
+        if mailbox is None:
+            with self._mailbox(folder=folder) as mailbox:
+                yield from self._get_raw_messages_from_folder(folder=folder, uids=uids, mailbox=mailbox, message_parts=message_parts)
+                return
 
-        return text
-    
-    def _get_folders(self) -> list[str]:
-        with MailBox(self.host).login(self.username, self.password) as mailbox:
-            folders : list[str] = []
-            for folder in mailbox.folder.list():
-                if folder.name in ["Outbox", "Notes", "Junk", "Drafts", "Trash"]:
-                    continue
+        for i in range(0, len(uids), self.fetch_batch_size):
+            fetch_result = mailbox.client.uid("FETCH", ",".join(uids[i:i + self.fetch_batch_size]), message_parts)
+            check_command_status(fetch_result, MailboxFetchError)
 
-                if folder.name.startswith("Sync Issues") or folder.name.startswith("Deleted"):  
-                    continue
+            # Each message is returned as an (envelope, body) tuple followed by the closing b")"
+            fetch_items = [item for item in fetch_result[1] if item is not None]
+            yield [fetch_items[j:j + 2] for j in range(0, len(fetch_items), 2)]
 
-                folders.append(folder.name)
+    def _thread_fetch_uid_range(self, folder: str, uids: list[str], parse_executor: Executor, parsed: queue.Queue, in_flight: threading.BoundedSemaphore) -> None:
+        # Use a single authenticated session for both the header scan and the fetch of missing emails
+        with self._mailbox(folder=folder) as mailbox:
+            self._fetch_uid_range(folder=folder, uids=uids, mailbox=mailbox, parse_executor=parse_executor, parsed=parsed, in_flight=in_flight)
 
-            return folders
-    
-    def _get_all_messages_from_folder(self, folder: str, headers_only: bool = False) -> list[MailMessage]:
-        with MailBox(self.host).login(self.username, self.password, initial_folder=folder) as mailbox:
-            messages = [msg for msg in mailbox.fetch(bulk=True, mark_seen=False, headers_only=headers_only)]
-            return messages
-    
-    def _get_specific_messages_from_folder(self, folder: str, uids: list[str]) -> list[MailMessage]:
-        with MailBox(self.host).login(self.username, self.password, initial_folder=folder) as mailbox:
-            messages = [msg for msg in mailbox.fetch(criteria=OR(uid=uids), bulk=True, mark_seen=False)]
-            return messages
-    
-    def _thread_fetch_emails_from_folder(self, folder):
-        print(f"{self.account.username}: Querying folder: {folder}")
-        messages = self._get_all_messages_from_folder(folder=folder, headers_only=True)
-        print(f"{self.account.username}: Found {len(messages)} messages in folder: {folder}")
+    def _fetch_uid_range(self, folder: str, uids: list[str], mailbox: MailBox, parse_executor: Executor, parsed: queue.Queue, in_flight: threading.BoundedSemaphore) -> None:
+        # These run while the progress bar is drawn, so write through tqdm to keep the bar on its own line
+        uid_range = f"UIDs {uids[0]}-{uids[-1]}"
+
+        tqdm.write(f"{self.account.username}: Querying {len(uids)} messages ({uid_range}) in folder: {folder}")
+        messages = self._get_message_id_headers_from_folder(folder=folder, uids=uids, mailbox=mailbox)
 
-        missing_emails: list[str] = []
+        uid_hashes: list[tuple[str, int]] = []
 
         for message in messages:
             try:
-                email, emailAttachments = self._convert_MailMessage_to_Email_and_EmailAttachments(folder=folder, message=message)
-
-                # First check if the email already exists
-                if self.db.check_email_exists(email):
-                    continue
-
+                hash = self.parser.generate_email_id_from_headers(date_str=message.date_str, from_=message.from_, subject=message.subject)
             except BaseException as e:
-                print(e)
+                tqdm.write(str(e))
                 continue
             
-            missing_emails.append(email.mailbox_id)
+            uid_hashes.append((message.uid or "", hash))
+
+        # Check which emails already exist with a single query rather than one per email
+        existing_hashes = self.db.existing_email_hashes([hash for _, hash in uid_hashes])
+        missing_emails: list[str] = [uid for uid, hash in uid_hashes if hash not in existing_hashes]
         
         if len(missing_emails) == 0:
             return
         
-        print(f"{self.account.username}: Fetching {len(missing_emails)} missing emails from folder: {folder}")
-
-        # Now fetch the full email
-        messages = self._get_specific_messages_from_folder(folder=folder, uids=missing_emails)
+        tqdm.write(f"{self.account.username}: Fetching {len(missing_emails)} missing emails ({uid_range}) from folder: {folder}")
 
-        for message in messages:
-            email, emailAttachments = self._convert_MailMessage_to_Email_and_EmailAttachments(folder=folder, message=message)
-            
-            self.db.add_email(email)
-            
-            for emailAttachment in emailAttachments:
-                self.db.add_emailAttachment(emailAttachment)
+        # Now fetch the full emails, handing each batch off to be parsed while the next one downloads
+        # Wait for a free slot before each batch so messages can't pile up faster than they are written
+        for batch in self._get_raw_messages_from_folder(folder=folder, uids=missing_emails, mailbox=mailbox):
+            in_flight.acquire()
+            try:
+                parsed.put(parse_executor.submit(parse_messages, self.account, folder, batch))
+            except BaseException:
+                # The slot is only released once a submitted batch is stored, so give it back if it never got that far
+                in_flight.release()
+                raise
         
-        print(f"{self.account.username}: Finished Fetching Emails from folder: {folder}")
+        tqdm.write(f"{self.account.username}: Finished Fetching Emails ({uid_range}) from folder: {folder}")
+
+    def _store_parsed_messages(self, parsed_messages: list[tuple[Email, list[EmailAttachment]]]) -> None:
+        emails: list[Email] = [email for email, _ in parsed_messages]
+        emailAttachments: list[EmailAttachment] = [emailAttachment for _, messageAttachments in parsed_messages for emailAttachment in messageAttachments]
+
+        # Write the whole batch in one transaction so it is committed once rather than once per row
+        with self.db.transaction():
+            self.db.add_emails_bulk(emails)
+            self.db.add_attachments_bulk([emailAttachment.attachment for emailAttachment in emailAttachments])
+            self.db.add_email_attachments_bulk(emailAttachments)
 
     def fetch_emails(self, folder: str = "ALL") -> None:
         if folder == "ALL":
@@ -183,12 +232,73 @@ class Client:
         else:
             folders = [folder]
 
-        
-        # Lets divide and conquer with concurrent.futures
-        with ThreadPoolExecutor(max_workers=14) as executor:
-            # Divide each folder into its own thread up to the max_workers
-            # executor.map will wait until all threads are finished
+        # Parse results from the fetch threads, plus each fetch thread itself once it has finished
+        parsed: queue.Queue[Future] = queue.Queue()
+
+        # Caps how many fetched batches can be waiting to be parsed or written at once
+        in_flight = threading.BoundedSemaphore(FOLDER_WORKERS * 2)
 
-            executor.map(self._thread_fetch_emails_from_folder, folders)
+        errors: list[BaseException] = []
+
+        # Downloading is network bound so it uses threads, but parsing is CPU bound so it uses processes to get around the GIL
+        # Worker processes are spawned rather than forked, as forking while the fetch threads hold locks isn't safe
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn")) as parse_executor, \
+                ThreadPoolExecutor(max_workers=FOLDER_WORKERS) as fetch_executor:
+            # Split every folder into UID ranges first, so a single large folder can be spread over several threads
+            # This has to finish before any range is fetched, otherwise the searches could queue behind ranges waiting for a free slot
+            search_futures: dict[Future, str] = {fetch_executor.submit(self._get_uid_ranges, folder): folder for folder in folders}
+
+            uid_ranges: list[tuple[str, list[str]]] = []
+            for future in as_completed(search_futures):
+                if future.exception() is not None:
+                    print(f"{self.account.username}: Failed to search folder: {search_futures[future]}: {future.exception()}")
+                    errors.append(future.exception()) # type: ignore
+                    continue
 
-        print(f"{self.account.username}: Finished Fetching Emails")
\ No newline at end of file
+                uid_ranges.extend((search_futures[future], uids) for uids in future.result())
+
+            with tqdm(total=len(uid_ranges), desc=self.account.username, unit="range") as progress:
+                # Each range gets its own thread (and IMAP session) up to the max_workers
+                range_futures: dict[Future, str] = {}
+                remaining_folder_ranges: dict[str, int] = {}
+                failed_folders: set[str] = set()
+                for folder, uids in uid_ranges:
+                    remaining_folder_ranges[folder] = remaining_folder_ranges.get(folder, 0) + 1
+                    future = fetch_executor.submit(self._thread_fetch_uid_range, folder, uids, parse_executor, parsed, in_flight)
+                    range_futures[future] = folder
+                    future.add_done_callback(parsed.put)
+
+                # Only this thread writes to the database, the fetch threads just fetch and hand off
+                # Keep draining after a failure, otherwise the other fetch threads would block waiting for a free slot
+                remaining_ranges = len(uid_ranges)
+                while remaining_ranges > 0:
+                    future = parsed.get()
+
+                    if future in range_futures:
+                        folder = range_futures[future]
+                        remaining_ranges -= 1
+                        remaining_folder_ranges[folder] -= 1
+                        progress.update(1)
+
+                        if future.exception() is not None:
+                            tqdm.write(f"{self.account.username}: Failed to fetch emails from folder: {folder}: {future.exception()}")
+                            errors.append(future.exception()) # type: ignore
+                            failed_folders.add(folder)
+
+                        # A range's batches are queued before the range itself, so by now they have all been stored
+                        if remaining_folder_ranges[folder] == 0 and folder not in failed_folders:
+                            tqdm.write(f"{self.account.username}: Finished folder: {folder}")
+                        continue
+
+                    try:
+                        self._store_parsed_messages(future.result())
+                    except Exception as e:
+                        tqdm.write(f"{self.account.username}: Failed to store emails: {e}")
+                        errors.append(e)
+                    finally:
+                        in_flight.release()
+
+        if len(errors) > 0:
+            raise RuntimeError(f"{self.account.username}: Failed to fetch emails, {len(errors)} error(s)") from errors[0]
+
+        print(f"{self.account.username}: Finished Fetching Emails")
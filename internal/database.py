@@ -1,15 +1,79 @@
 import sqlite3
+import threading
 from .models import Account, Attachment, Email, EmailAttachment
+from contextlib import contextmanager
 from datetime import datetime
-import json
+import orjson
 
-from typing import Tuple
+from typing import Iterator, Tuple
+
+EMAIL_COLUMNS = "hash, account_id, datetime, mailbox, mailbox_id, from_address, to_addresses, subject, thread, text, analytics_version, analytics_data"
+
+# Older SQLite builds cap the number of bound parameters in a statement at 999
+SQLITE_MAX_VARIABLES = 900
+
+# sqlite3 keeps this many prepared statements per connection, keyed on the SQL text, so hot queries skip re-parsing
+SQLITE_CACHED_STATEMENTS = 256
+
+INSERT_OR_IGNORE_EMAIL_SQL = f"INSERT OR IGNORE INTO emails ({EMAIL_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+# Always bound with a full chunk, so a single prepared statement serves every lookup
+EXISTING_EMAIL_HASHES_SQL = f"SELECT hash FROM emails WHERE hash IN ({','.join('?' * SQLITE_MAX_VARIABLES)})"
 
 class Database:
-    def __init__(self, db: sqlite3.Connection) -> None:
-        self.db: sqlite3.Connection = db
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+
+        # Each thread gets its own connection, so with WAL readers don't block the writer and threads don't share a connection lock
+        self._local = threading.local()
+
+        self._check_schema()
         self._create_tables()
 
+    def _conn(self) -> sqlite3.Connection:
+        conn: sqlite3.Connection | None = getattr(self._local, "conn", None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=SQLITE_CACHED_STATEMENTS)
+            self._configure_connection(conn)
+            self._local.conn = conn
+
+        return conn
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        return self._conn()
+
+    def _configure_connection(self, conn: sqlite3.Connection) -> None:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA busy_timeout = 5000")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -65536")
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        # The connection is in autocommit mode, so group writes explicitly to commit (and fsync) once
+        # Take the write lock up front, waiting on busy_timeout, rather than failing if another connection is writing
+        conn = self._conn()
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def _check_schema(self) -> None:
+        # Databases from before email ids became integers store them as TEXT, which never compare equal to the new ids
+        # The old ids can't be converted, as they were hashed differently, so fail loudly rather than re-fetching everything on every sync
+        hash_types = [row[2].upper() for row in self.db.execute("PRAGMA table_info(emails)") if row[1] == "hash"]
+
+        if len(hash_types) > 0 and hash_types[0] != "INTEGER":
+            raise RuntimeError(f"{self.path} uses an old schema with {hash_types[0]} email ids, move it aside so the emails can be fetched into a new database")
+
     # Create Tables
     def _create_tables(self) -> None:
         self.db.execute("""
@@ -22,7 +86,7 @@ class Database:
 
         self.db.execute("""
             CREATE TABLE IF NOT EXISTS emails (
-                hash TEXT PRIMARY KEY,
+                hash INTEGER PRIMARY KEY,
                 account_id INTEGER,
                 datetime TEXT,
                 mailbox TEXT,
@@ -41,8 +105,8 @@ class Database:
         self.db.execute("""
             CREATE TABLE IF NOT EXISTS email_attachments (
                 account_id INTEGER,
-                email_hash TEXT,
-                attachment_hash TEXT,
+                email_hash INTEGER,
+                attachment_hash BLOB,
                 filename TEXT,
                 content_type TEXT,
                 FOREIGN KEY(account_id) REFERENCES accounts(id),
@@ -54,39 +118,44 @@ class Database:
 
         self.db.execute("""
             CREATE TABLE IF NOT EXISTS attachments (
-                hash TEXT PRIMARY KEY,
+                hash BLOB PRIMARY KEY,
                 content BLOB
             )
         """)
 
+        # Indexes for the getters, which all filter by account and sort by datetime
+        self.db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_emails_acct_dt ON emails(account_id, datetime DESC)
+        """)
+
+        self.db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_emails_acct_thread_dt ON emails(account_id, thread, datetime DESC)
+        """)
+
+        self.db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_emails_acct_ver ON emails(account_id, analytics_version)
+        """)
+
+        # Refresh the statistics the query planner uses to choose between the indexes
+        self.db.execute("ANALYZE")
+
         self.db.commit()
 
-    def check_email_attachment_exists(self, emailAttachment: EmailAttachment) -> bool:
-        cursor = self.db.execute("""
-            SELECT attachment_hash
-            FROM email_attachments
-            WHERE account_id = ? AND email_hash = ? AND attachment_hash = ?
-        """, (emailAttachment.account_id, emailAttachment.email_hash, emailAttachment.attachment_hash))
+    def existing_email_hashes(self, hashes: list[int]) -> set[int]:
+        # Look up many hashes at once, chunked to stay under SQLite's limit on the number of bound variables
+        existing: set[int] = set()
 
-        return cursor.fetchone() is not None
-    
-    def check_attachment_exists(self, attachment: Attachment) -> bool:
-        cursor = self.db.execute("""
-            SELECT hash
-            FROM attachments
-            WHERE hash = ?
-        """, (attachment.hash,))
+        for i in range(0, len(hashes), SQLITE_MAX_VARIABLES):
+            chunk = hashes[i:i + SQLITE_MAX_VARIABLES]
 
-        return cursor.fetchone() is not None
+            # Pad the last chunk with a repeated hash rather than preparing a statement for its length
+            chunk += [chunk[0]] * (SQLITE_MAX_VARIABLES - len(chunk))
 
-    def check_email_exists(self, email: Email) -> bool:
-        cursor = self.db.execute("""
-            SELECT hash
-            FROM emails
-            WHERE hash = ?
-        """, (email.hash,))
+            cursor = self.db.execute(EXISTING_EMAIL_HASHES_SQL, chunk)
+
+            existing.update(row[0] for row in cursor)
 
-        return cursor.fetchone() is not None
+        return existing
     
     def get_account(self, username: str) -> Account:
         # Check if account exists, if not, create it
@@ -124,46 +193,34 @@ class Database:
 
         self.db.commit()    
     
-    def _add_attachment(self, attachment: Attachment) -> None:
-        self.db.execute("""
-            INSERT INTO attachments (hash, content) VALUES (?, ?)
-        """, (attachment.hash, attachment.content))
-
-        self.db.commit()
-
-    def add_emailAttachment(self, emailAttachment: EmailAttachment) -> None:  
-        # We want to add the attachment to the database if it doesn't exist
-        # Otherwise, we want to not duplicate the attachment
-        # but still add it to the email_attachments table as a link
-
-        if not self.check_attachment_exists(emailAttachment.attachment):
-            self._add_attachment(emailAttachment.attachment)
-
-        if not self.check_email_attachment_exists(emailAttachment):
-            self.db.execute("""
-                INSERT INTO email_attachments (account_id, email_hash, attachment_hash, filename, content_type)
-                VALUES (?, ?, ?, ?, ?)
-            """, (emailAttachment.account_id, emailAttachment.email_hash, emailAttachment.attachment_hash, emailAttachment.filename, emailAttachment.content_type))  
-
-            self.db.commit()
-
-    def add_email(self, email: Email) -> None:
-        self.db.execute("""
-            INSERT INTO emails (
-                hash,
-                account_id,
-                datetime,
-                mailbox,
-                mailbox_id,
-                from_address,
-                to_addresses,
-                subject,
-                thread,
-                text,
-                analytics_version,
-                analytics_data
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
+    def add_emails_bulk(self, emails: list[Email]) -> None:
+        self.add_emails_from_tuples([self._email_to_row(email) for email in emails])
+
+    def add_emails_from_tuples(self, rows: list[tuple]) -> None:
+        # Rows are in EMAIL_COLUMNS order, for callers that have the values without building Email objects
+        # The same email can appear in more than one folder, so ignore any that have already been added
+        self.db.executemany(INSERT_OR_IGNORE_EMAIL_SQL, rows)
+
+    def add_attachments_bulk(self, attachments: list[Attachment]) -> None:
+        # Attachments are shared between emails, so don't duplicate any we already have
+        self.db.executemany("""
+            INSERT OR IGNORE INTO attachments (hash, content) VALUES (?, ?)
+        """, [(attachment.hash, attachment.content) for attachment in attachments])
+
+    def add_email_attachments_bulk(self, emailAttachments: list[EmailAttachment]) -> None:
+        self.db.executemany("""
+            INSERT OR IGNORE INTO email_attachments (account_id, email_hash, attachment_hash, filename, content_type)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(
+            emailAttachment.account_id,
+            emailAttachment.email_hash,
+            emailAttachment.attachment_hash,
+            emailAttachment.filename,
+            emailAttachment.content_type
+        ) for emailAttachment in emailAttachments])
+
+    def _email_to_row(self, email: Email) -> tuple:
+        return (
             email.hash,
             email.account_id,
             email.datetime,
@@ -175,13 +232,22 @@ class Database:
             email.thread,
             email.text,
             email.analytics_version,
-            json.dumps(email.analytics_data)
-        ))
-
-        self.db.commit()
+            orjson.dumps(email.analytics_data, option=orjson.OPT_NON_STR_KEYS).decode()
+        )
     
     # Different Getters for different purposes
-    def get_emails(self, account: Account) -> list[Email]:
+    def iter_emails_summary(self, account: Account) -> Iterator[Tuple[str, str, str]]:
+        # Just the fields needed for listing emails, without building Email objects or decoding JSON
+        cursor = self.db.execute("""
+            SELECT datetime, mailbox, subject
+            FROM emails
+            WHERE account_id = ?
+            ORDER BY datetime DESC
+        """, (account.id,))
+
+        yield from cursor
+    
+    def get_emails(self, account: Account) -> Iterator[Email]:
         cursor = self.db.execute("""
             SELECT hash, account_id, datetime, mailbox, mailbox_id, from_address, to_addresses, subject, thread, text, analytics_version, analytics_data
             FROM emails
@@ -189,20 +255,22 @@ class Database:
             ORDER BY datetime DESC
         """, (account.id,))
 
-        return [Email(
-            hash=row[0],
-            account_id=row[1],
-            datetime=datetime.fromisoformat(row[2]),
-            mailbox=row[3],
-            mailbox_id=row[4],
-            from_address=row[5],
-            to_addresses=row[6],
-            subject=row[7],
-            thread=row[8],
-            text=row[9],
-            analytics_version=row[10],
-            analytics_data=json.loads(row[11])
-        ) for row in cursor.fetchall()]
+        # Iterate the cursor rather than fetching everything, so only one row is held in memory at a time
+        for row in cursor:
+            yield Email(
+                hash=row[0],
+                account_id=row[1],
+                datetime=datetime.fromisoformat(row[2]),
+                mailbox=row[3],
+                mailbox_id=row[4],
+                from_address=row[5],
+                to_addresses=row[6],
+                subject=row[7],
+                thread=row[8],
+                text=row[9],
+                analytics_version=row[10],
+                analytics_data=orjson.loads(row[11])
+            )
     
     def get_emails_with_analytics_version_less_than(self, account: Account, version: int) -> list[Email]:
         cursor = self.db.execute("""
@@ -224,13 +292,13 @@ class Database:
             thread=row[8],
             text=row[9],
             analytics_version=row[10],
-            analytics_data=json.loads(row[11])
+            analytics_data=orjson.loads(row[11])
         ) for row in cursor.fetchall()]
     
     def update_email_analytics(self, email: Email, version: int, data: dict) -> None:
         self.db.execute("""
             UPDATE emails SET analytics_version = ?, analytics_data = ? WHERE hash = ?
-        """, (version, json.dumps(data), email.hash))
+        """, (version, orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode(), email.hash))
 
         self.db.commit()
     
@@ -240,7 +308,7 @@ class Database:
         # We also want to get the number of emails in each thread
 
         cursor = self.db.execute("""
-            SELECT thread, COUNT(*) FROM emails WHERE account_id = ? GROUP BY thread ORDER BY datetime DESC
+            SELECT thread, COUNT(*) FROM emails WHERE account_id = ? GROUP BY thread ORDER BY MAX(datetime) DESC
         """, (account.id,))
 
         return cursor.fetchall()
@@ -267,7 +335,7 @@ class Database:
             thread=row[8],
             text=row[9],
             analytics_version=row[10],
-            analytics_data=json.loads(row[11])
+            analytics_data=orjson.loads(row[11])
         ) for row in cursor.fetchall()]
     
     def get_list_of_accounts(self) -> list[Account]:
@@ -2,15 +2,15 @@ from dataclasses import dataclass
 from datetime import datetime
 from typing import Any
 
-@dataclass
+@dataclass(slots=True)
 class Account:
     id: int
     username: str
     last_synced: datetime
 
-@dataclass
+@dataclass(slots=True)
 class Email:
-    hash: str
+    hash: int
     account_id: int
     datetime: datetime
     mailbox: str
@@ -23,16 +23,16 @@ class Email:
     analytics_version: int
     analytics_data: dict[str, Any]
 
-@dataclass
+@dataclass(slots=True)
 class Attachment:
-    hash: str
+    hash: bytes
     content: bytes
 
-@dataclass
+@dataclass(slots=True)
 class EmailAttachment:
     account_id: int
-    email_hash: str
-    attachment_hash: str
+    email_hash: int
+    attachment_hash: bytes
     filename: str
     content_type: str
     attachment: Attachment
\ No newline at end of file
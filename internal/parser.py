@@ -0,0 +1,208 @@
+import hashlib
+import re
+import xxhash
+
+from collections import OrderedDict
+
+from imap_tools import MailMessage
+from inscriptis import get_text
+from inscriptis.model.config import ParserConfig
+from selectolax.lexbor import LexborHTMLParser
+
+from .models import Account, Attachment, Email, EmailAttachment
+
+# Patterns used on every message, compiled once up front
+_PREFIX_RE = re.compile(r'\b(?:re|fwd):\s')
+_DATE_RE = re.compile(r':\s+\w+\s+\d{1,2},\s+\d{4}')
+_WS_RE = re.compile(r'\s+')
+_HEADER_LINE_RE = re.compile(r'^(?:FROM|TO|SUBJECT|DATE|CC|BCC):\s|^>+\s', re.IGNORECASE)
+_TABLE_RE = re.compile(r'<table\b', re.IGNORECASE)
+_BOILERPLATE_RE = re.compile("|".join(re.escape(boilerplate) for boilerplate in (
+    "________________________________",
+    "This message was sent from a notification-only email address that does not accept incoming email. Please do not reply to this message.",
+    "This is an automated message. Please do not reply to this email."
+)))
+
+HTML_LINE_BREAK_SELECTOR = "br, p, div, li, tr, h1, h2, h3, h4, h5, h6, blockquote"
+
+# Preheaders and tracking text that isn't shown to the reader, inscriptis leaves these out too
+HTML_HIDDEN_SELECTOR = '[hidden], [style*="display:none"], [style*="display: none"]'
+
+# Shared by every call to inscriptis rather than it building a new config each time
+INSCRIPTIS_CONFIG = ParserConfig()
+
+# Attachment types that aren't worth storing, calendar invites, forwarded messages and alternative bodies
+SKIPPED_ATTACHMENT_CONTENT_TYPES = frozenset({
+    "application/ics", "text/calendar", "text/calender",
+    "message/rfc822", "message/delivery-status", "text/html", "text/plain"
+})
+
+# The same attachments (signatures, policy documents, etc.) turn up in many emails, so remember the SHA-256 of recent ones
+# keyed by a much cheaper xxh3 digest of the payload
+# Parsing runs in single threaded worker processes, so each one keeps its own cache and needs no lock
+ATTACHMENT_HASH_CACHE_SIZE = 4096
+_attachment_hash_cache: OrderedDict[bytes, bytes] = OrderedDict()
+
+def hash_attachment(payload: bytes) -> bytes:
+    key = xxhash.xxh3_128_digest(payload)
+
+    digest = _attachment_hash_cache.get(key)
+    if digest is not None:
+        _attachment_hash_cache.move_to_end(key)
+        return digest
+
+    # The hash is only used for de-duplication, which lets OpenSSL pick its fastest SHA-256 implementation
+    digest = hashlib.sha256(payload, usedforsecurity=False).digest()
+
+    _attachment_hash_cache[key] = digest
+    if len(_attachment_hash_cache) > ATTACHMENT_HASH_CACHE_SIZE:
+        _attachment_hash_cache.popitem(last=False)
+
+    return digest
+
+class MessageParser:
+    # Converts fetched messages into models, it only needs the account so it can be sent to a worker process
+    def __init__(self, account: Account) -> None:
+        self.account: Account = account
+    
+    def convert_MailMessage_to_Email_and_EmailAttachments(self, folder: str, message: MailMessage) -> tuple[Email, list[EmailAttachment]]:
+        to_addresses = ",".join([email.email.lower() for email in message.to_values])
+
+        subject = message.subject.replace("\n", " ").strip()
+
+        email = Email(
+            hash = self.generate_email_id(message=message),
+            account_id = self.account.id,
+            datetime = message.date,
+            mailbox = folder,
+            mailbox_id = (message.uid or ""),
+            from_address = message.from_.lower(),
+            to_addresses = to_addresses,
+            subject = subject,
+            thread = self.convert_subject_to_thread(subject=subject),
+            text = self.get_text(message=message),
+            analytics_version = 0,
+            analytics_data = {}
+        )
+
+        emailAttachments: list[EmailAttachment] = []
+
+        for message_attachment in message.attachments:
+            # Exclude certain file types
+            content_type = message_attachment.content_type
+            if content_type in SKIPPED_ATTACHMENT_CONTENT_TYPES or content_type.startswith("image/"):
+                continue
+
+            attachment = Attachment(
+                hash = hash_attachment(message_attachment.payload),
+                content = message_attachment.payload
+            )
+
+            emailAttachment = EmailAttachment(
+                account_id = self.account.id,
+                email_hash = email.hash,
+                attachment_hash = attachment.hash,
+                filename = message_attachment.filename,
+                content_type = message_attachment.content_type,
+                attachment = attachment
+            )
+
+            emailAttachments.append(emailAttachment)
+        
+        return email, emailAttachments
+
+    def generate_email_id(self, message: MailMessage) -> int:
+        return self.generate_email_id_from_headers(date_str=message.date_str, from_=message.from_, subject=message.subject)
+
+    def generate_email_id_from_headers(self, date_str: str, from_: str, subject: str) -> int:
+        # Only needs the headers, so existing emails can be identified without building an Email
+        digest = xxhash.xxh3_64_intdigest(f"{self.account.username}_{date_str}{from_}{subject}".encode())
+
+        # SQLite integers are signed 64-bit, so map the unsigned digest onto that range
+        return digest - (1 << 64) if digest >= (1 << 63) else digest
+
+    def convert_subject_to_thread(self, subject: str) -> str:
+        thread = subject.lower()
+
+        # Strip out all Re: and Fwd: from the subject
+        thread = _PREFIX_RE.sub('', thread)
+
+        thread = _DATE_RE.sub('', thread)
+
+        # Now strip all Emoji Characters, leaving only ASCII
+        thread = thread.encode("ascii", "ignore").decode()
+
+        # Now join multiple lines into one
+        thread = " ".join(thread.splitlines())
+
+        # Now replace multiple spaces with a single space
+        thread = _WS_RE.sub(' ', thread)
+    
+        return thread
+    
+    def get_text_from_html(self, html: str) -> str:
+        # selectolax is much faster for simple emails, but inscriptis does a better job of laying out tables
+        if not _TABLE_RE.search(html):
+            tree = LexborHTMLParser(html)
+            tree.strip_tags(["script", "style"])
+
+            for node in tree.css(HTML_HIDDEN_SELECTOR):
+                node.decompose()
+
+            # Only break lines at block elements, so inline formatting doesn't split a sentence
+            # Break after them as well as before, so text following a closing block starts on its own line
+            for node in tree.css(HTML_LINE_BREAK_SELECTOR):
+                node.insert_before("\n")
+                if node.tag != "br":
+                    node.insert_after("\n")
+
+            # inscriptis renders &nbsp; as a plain space, so match it
+            text = tree.body.text(separator="").replace("\xa0", " ") if tree.body is not None else ""
+            if text.strip() != "":
+                return text
+
+        return get_text(html_content=html, config=INSCRIPTIS_CONFIG)
+
+    def get_text(self, message: MailMessage) -> str:
+        text: str = ""
+        if message.html != "":
+            text = self.get_text_from_html(html=message.html)
+        elif message.text != "":
+            text = message.text
+        
+        lines: list[str] = []
+        for line in text.split("\n"):
+            # Trim whitespace from the beginning and end of each line
+            line = line.strip()
+
+            # Now strip out all the empty lines
+            if line == "":
+                continue
+
+            # Strip out any lines that start with RFC 5322 Message Headers, e.g. "From: ", "To: ", "Subject: ", etc. or a quoted reply
+            if _HEADER_LINE_RE.match(line):
+                continue
+
+            lines.append(line)
+
+        text = "\n".join(lines)
+
+        # Now remove content that does not provide any value
+        text = _BOILERPLATE_RE.sub("", text)
+
+        return text
+
+def parse_messages(account: Account, folder: str, fetched_messages: list[list]) -> list[tuple[Email, list[EmailAttachment]]]:
+    # Runs in a worker process, so the CPU heavy parsing isn't serialised on the GIL
+    parser = MessageParser(account=account)
+
+    parsed_messages: list[tuple[Email, list[EmailAttachment]]] = []
+
+    for fetch_data in fetched_messages:
+        try:
+            parsed_messages.append(parser.convert_MailMessage_to_Email_and_EmailAttachments(folder=folder, message=MailMessage(fetch_data)))
+        except Exception as e:
+            print(e)
+            continue
+
+    return parsed_messages
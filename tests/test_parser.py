@@ -0,0 +1,36 @@
+from datetime import datetime
+
+from imap_tools import MailMessage
+
+from internal.models import Account
+from internal.parser import MessageParser
+
+ACCOUNT = Account(id=1, username="u", last_synced=datetime(1970, 1, 1))
+
+def _html_message(html: str) -> MailMessage:
+    return MailMessage.from_bytes(f"Content-Type: text/html; charset=utf-8\r\n\r\n{html}".encode())
+
+def test_get_text_from_html_breaks_after_block_elements() -> None:
+    parser = MessageParser(account=ACCOUNT)
+
+    assert parser.get_text_from_html("<div>Hello</div>World").split() == ["Hello", "World"]
+    assert parser.get_text_from_html("<p>Regards,</p>Bob").splitlines()[-1] == "Bob"
+
+def test_get_text_from_html_keeps_inline_elements_on_one_line() -> None:
+    parser = MessageParser(account=ACCOUNT)
+
+    assert parser.get_text_from_html("<p>Hello&nbsp;<b>there</b> Bob</p>").strip() == "Hello there Bob"
+
+def test_get_text_drops_quoted_reply_after_block() -> None:
+    parser = MessageParser(account=ACCOUNT)
+
+    text = parser.get_text(_html_message("<div>Thanks</div><div>On Mon, X wrote:</div>&gt; quoted"))
+
+    assert "quoted" not in text
+    assert "Thanks" in text
+
+def test_get_text_from_html_skips_hidden_elements() -> None:
+    parser = MessageParser(account=ACCOUNT)
+
+    assert parser.get_text_from_html("<div style='display:none'>preheader</div><p>Body</p>").strip() == "Body"
+    assert parser.get_text_from_html("<span hidden>tracking</span><p style=\"display: none\">more</p><p>Body</p>").strip() == "Body"